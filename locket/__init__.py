@@ -1,4 +1,6 @@
 import errno
+import os
+import signal
 import threading
 from time import sleep
 import weakref
@@ -8,7 +10,11 @@ try:
 except ImportError:
     from time import time as get_time
 
-__all__ = ["lock_file"]
+__all__ = ["lock_file", "lock_files"]
+
+# Errnos that mean a non-blocking lock attempt failed because somebody
+# else holds the lock, checked on every contended attempt.
+_RETRY_ERRNOS = frozenset((errno.EACCES, errno.EAGAIN))
 
 
 try:
@@ -30,10 +36,43 @@ except ImportError:
         _WinAPI_UnlockFile.restype = ctypes.wintypes.BOOL
         _WinAPI_UnlockFile.argtypes = [ctypes.wintypes.HANDLE] + [ctypes.wintypes.DWORD] * 4
 
-        _lock_file_blocking_available = False
+        class _OVERLAPPED(ctypes.Structure):
+            _fields_ = [
+                ("Internal", ctypes.wintypes.LPVOID),
+                ("InternalHigh", ctypes.wintypes.LPVOID),
+                ("Offset", ctypes.wintypes.DWORD),
+                ("OffsetHigh", ctypes.wintypes.DWORD),
+                ("hEvent", ctypes.wintypes.HANDLE),
+            ]
+
+        _WinAPI_LockFileEx = _kernel32.LockFileEx
+        _WinAPI_LockFileEx.restype = ctypes.wintypes.BOOL
+        _WinAPI_LockFileEx.argtypes = (
+            [ctypes.wintypes.HANDLE] +
+            [ctypes.wintypes.DWORD] * 4 +
+            [ctypes.POINTER(_OVERLAPPED)]
+        )
+
+        _LOCKFILE_EXCLUSIVE_LOCK = 0x2
+
+        _lock_file_blocking_available = True
+
+        def _lock_file_blocking(fd):
+            # Lock the same single byte as the non-blocking path, but
+            # let the kernel block until it's available instead of
+            # polling.
+            overlapped = _OVERLAPPED()
+            res = _WinAPI_LockFileEx(
+                msvcrt.get_osfhandle(fd),
+                _LOCKFILE_EXCLUSIVE_LOCK,
+                0, 1, 0,
+                ctypes.byref(overlapped),
+            )
+            if not res:
+                raise ctypes.WinError(ctypes.get_last_error())
 
-        def _lock_file_non_blocking(file_):
-            res = _WinAPI_LockFile(msvcrt.get_osfhandle(file_.fileno()), 0, 0, 1, 0)
+        def _lock_file_non_blocking(fd):
+            res = _WinAPI_LockFile(msvcrt.get_osfhandle(fd), 0, 0, 1, 0)
             if res:
                 return True
             else:
@@ -43,42 +82,250 @@ except ImportError:
                     raise ctypes.WinError(err)
                 return False
 
-        def _unlock_file(file_):
-            _WinAPI_UnlockFile(msvcrt.get_osfhandle(file_.fileno()), 0, 0, 1, 0)
+        def _unlock_file(fd):
+            _WinAPI_UnlockFile(msvcrt.get_osfhandle(fd), 0, 0, 1, 0)
+
+        def _lock_file_blocking_with_timeout(fd, timeout, error_message):
+            return False
 
 else:
     _lock_file_blocking_available = True
-    def _lock_file_blocking(file_):
-        fcntl.flock(file_.fileno(), fcntl.LOCK_EX)
 
-    def _lock_file_non_blocking(file_):
-        try:
-            fcntl.flock(file_.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-            return True
-        except IOError as error:
-            if error.errno in [errno.EACCES, errno.EAGAIN]:
+    if hasattr(fcntl, "F_OFD_SETLKW"):
+        import struct
+
+        # Open file description locks (Linux >= 3.15) behave like flock
+        # (tied to the open file description, not the process) but go
+        # through the POSIX byte-range lock path, which scales better
+        # under many concurrent lockers. OFD locks and flock locks don't
+        # conflict with each other, though, and fcntl only exposes the
+        # F_OFD constants on some interpreters, so the flock lock is
+        # always taken as well: a process that can only flock (an older
+        # locket, or a Python without F_OFD) still excludes and is
+        # excluded by processes that take both. The OFD lock is only
+        # ever taken while the flock lock is held, so it never blocks.
+        #
+        # struct flock: l_type, l_whence, l_start, l_len, l_pid (plus
+        # trailing padding). Packed once so the hot path passes
+        # ready-made bytes.
+        _flock_format = struct.Struct("hhqqii")
+        _wrlck = _flock_format.pack(fcntl.F_WRLCK, os.SEEK_SET, 0, 0, 0, 0)
+        _unlck = _flock_format.pack(fcntl.F_UNLCK, os.SEEK_SET, 0, 0, 0, 0)
+
+        # The arguments are bound as defaults so the common
+        # timeout=None acquire runs with local reads rather than module
+        # attribute lookups.
+        def _lock_file_blocking(fd,
+                _flock=fcntl.flock, _flags=fcntl.LOCK_EX,
+                _fcntl=fcntl.fcntl, _setlkw=fcntl.F_OFD_SETLKW, _lck=_wrlck):
+            _flock(fd, _flags)
+            _fcntl(fd, _setlkw, _lck)
+
+        def _lock_file_non_blocking(fd):
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as error:
+                if error.errno in _RETRY_ERRNOS:
+                    return False
+                else:
+                    raise
+            try:
+                fcntl.fcntl(fd, fcntl.F_OFD_SETLK, _wrlck)
+                return True
+            except IOError as error:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                if error.errno in _RETRY_ERRNOS:
+                    return False
+                else:
+                    raise
+
+        def _unlock_file(fd):
+            fcntl.fcntl(fd, fcntl.F_OFD_SETLK, _unlck)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        # As above, bound as defaults to keep the blocking acquire to a
+        # single call with local reads.
+        def _lock_file_blocking(fd, _flock=fcntl.flock, _flags=fcntl.LOCK_EX):
+            _flock(fd, _flags)
+
+        def _fcntl_lock_file_non_blocking(fd):
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except IOError as error:
+                if error.errno in _RETRY_ERRNOS:
+                    return False
+                else:
+                    raise
+
+        def _unlock_file(fd):
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+        # Failed non-blocking attempts are the hot path under contention:
+        # calling flock through libc and checking the return value avoids
+        # constructing a Python exception per failed attempt.
+        def _make_libc_lock_file_non_blocking():
+            try:
+                import ctypes
+                libc_flock = ctypes.CDLL(None, use_errno=True).flock
+                libc_flock.argtypes = [ctypes.c_int, ctypes.c_int]
+                libc_flock.restype = ctypes.c_int
+            except (ImportError, OSError, AttributeError):
+                return None
+
+            # EINTR also counts as a failed attempt here since the
+            # surrounding loop retries anyway.
+            retry_errnos = _RETRY_ERRNOS | frozenset((errno.EINTR,))
+
+            def _libc_lock_file_non_blocking(fd):
+                if libc_flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB) == 0:
+                    return True
+                error = ctypes.get_errno()
+                if error in retry_errnos:
+                    return False
+                else:
+                    raise IOError(error, os.strerror(error))
+
+            return _libc_lock_file_non_blocking
+
+        def _lock_file_non_blocking(fd):
+            # Loading libc through ctypes is comparatively expensive, so
+            # it's deferred from import time to the first non-blocking
+            # attempt, after which this function rebinds itself to the
+            # real implementation.
+            global _lock_file_non_blocking
+            _lock_file_non_blocking = (
+                _make_libc_lock_file_non_blocking() or
+                _fcntl_lock_file_non_blocking
+            )
+            return _lock_file_non_blocking(fd)
+
+    if hasattr(signal, "setitimer"):
+        def _lock_file_blocking_with_timeout(fd, timeout, error_message):
+            # Signals are only delivered to the main thread, and arming
+            # ITIMER_REAL would trample a timer the application has set.
+            if (not _in_main_thread() or
+                    signal.getitimer(signal.ITIMER_REAL) != (0.0, 0.0)):
                 return False
-            else:
-                raise
 
-    def _unlock_file(file_):
-        fcntl.flock(file_.fileno(), fcntl.LOCK_UN)
+            # The handler has to raise: a handler that returns normally
+            # causes the interrupted flock call to be retried (PEP 475).
+            def _handle_timeout(signum, frame):
+                raise LockError(error_message)
+
+            previous_handler = signal.signal(signal.SIGALRM, _handle_timeout)
+            try:
+                signal.setitimer(signal.ITIMER_REAL, timeout)
+                try:
+                    _lock_file_blocking(fd)
+                except IOError as error:
+                    if error.errno == errno.EINTR:
+                        _unlock_file(fd)
+                        raise LockError(error_message)
+                    else:
+                        raise
+                except LockError:
+                    # The timer can fire after the lock call has succeeded
+                    # but before it's disarmed below, in which case the
+                    # kernel lock is held even though the acquire is about
+                    # to report a timeout. Unlocking is a harmless no-op
+                    # when the lock wasn't actually taken (the fd is
+                    # serialized under _ThreadLock), so release
+                    # defensively rather than keep a lock the caller
+                    # believes timed out.
+                    _unlock_file(fd)
+                    raise
+            finally:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, previous_handler)
+            return True
+    else:
+        def _lock_file_blocking_with_timeout(fd, timeout, error_message):
+            return False
+
+
+# O_CLOEXEC (O_NOINHERIT on Windows) stops spawned children from
+# inheriting the lock fd and unwittingly holding the lock after the
+# parent has exited. O_TRUNC is deliberately absent: the lock file's
+# contents are irrelevant, so there's no need to truncate it. The file
+# can't be opened read-only, though: taking a write lock with
+# F_OFD_SETLK requires a writable fd.
+_open_flags = (
+    os.O_WRONLY |
+    os.O_CREAT |
+    getattr(os, "O_CLOEXEC", 0) |
+    getattr(os, "O_NOINHERIT", 0)
+)
+
+
+if hasattr(threading, "main_thread"):
+    def _in_main_thread():
+        return threading.current_thread() is threading.main_thread()
+else:
+    def _in_main_thread():
+        return isinstance(threading.current_thread(), threading._MainThread)
 
 
 _locks_lock = threading.Lock()
 _locks = weakref.WeakValueDictionary()
 
 
-def lock_file(path, **kwargs):
+def lock_file(path, preopen=False, **kwargs):
+    lock = _get_lock(path)
+    if preopen:
+        lock.preopen()
+    return _Locker(lock, **kwargs)
+
+
+def lock_files(paths, preopen=False, **kwargs):
+    # Paths are deduplicated and acquired in a canonical order so that two
+    # callers locking overlapping sets of paths cannot deadlock each
+    # other. realpath is used so that different spellings of the same file
+    # (for instance via symlinks) are deduplicated and sort identically in
+    # every process; without the dedup, a set containing the same file
+    # twice would block on its own first acquisition.
+    locks = []
+    for lock_path in sorted(set(os.path.realpath(path) for path in paths)):
+        lock = _get_lock(lock_path)
+        if lock not in locks:
+            locks.append(lock)
+    lock_set = _LockSet(locks)
+    if preopen:
+        lock_set.preopen()
+    return _Locker(lock_set, **kwargs)
+
+
+def _lock_key(path):
+    # The path is fully resolved - including the final component, so a
+    # symlink to a lock file shares a key with its target - and then the
+    # containing directory is identified by device and inode, which also
+    # sees through bind mounts that realpath can't. The directory is
+    # statted rather than the file so that the key is the same whether or
+    # not the lock file exists yet.
+    real_path = os.path.realpath(path)
+    directory, name = os.path.split(real_path)
+    try:
+        stat = os.stat(directory)
+    except OSError:
+        stat = None
+    if stat is None or stat.st_ino == 0:
+        # The directory is missing, or the platform has no meaningful
+        # inode numbers.
+        return real_path
+    return (stat.st_dev, stat.st_ino, name)
+
+
+def _get_lock(path):
+    key = _lock_key(path)
     _locks_lock.acquire()
     try:
-        lock = _locks.get(path)
+        lock = _locks.get(key)
         if lock is None:
-            lock = _create_lock_file(path)
-            _locks[path] = lock
+            lock = _create_lock_file(os.path.abspath(path))
+            _locks[key] = lock
     finally:
         _locks_lock.release()
-    return _Locker(lock, **kwargs)
+    return lock
 
 
 def _create_lock_file(path):
@@ -91,26 +338,42 @@ class LockError(Exception):
     pass
 
 
-def _acquire_non_blocking(acquire, timeout, retry_period, path):
+def _acquire_non_blocking(acquire, timeout, retry_period, error_message,
+        # Bound as defaults so the loop reads locals rather than doing a
+        # global lookup per iteration.
+        _sleep=sleep, _get_time=get_time):
     if retry_period is None:
         retry_period = 0.05
 
-    start_time = get_time()
+    # Start with short sleeps so that quickly released locks are picked up
+    # with little delay, backing off towards retry_period while waiting.
+    sleep_time = min(0.001, retry_period)
+    if timeout is None:
+        deadline = None
+    else:
+        deadline = _get_time() + timeout
     while True:
         success = acquire()
         if success:
             return
-        elif (timeout is not None and
-                get_time() - start_time > timeout):
-            raise LockError("Couldn't lock {0}".format(path))
+        elif deadline is not None and _get_time() > deadline:
+            raise LockError(error_message)
         else:
-            sleep(retry_period)
+            if deadline is None:
+                _sleep(sleep_time)
+            else:
+                _sleep(min(sleep_time, max(0, deadline - _get_time())))
+            sleep_time = min(sleep_time * 1.5, retry_period)
 
 
 class _LockSet(object):
     def __init__(self, locks):
         self._locks = locks
 
+    def preopen(self):
+        for lock in self._locks:
+            lock.preopen()
+
     def acquire(self, timeout, retry_period):
         acquired_locks = []
         try:
@@ -132,9 +395,22 @@ class _LockSet(object):
 class _ThreadLock(object):
     def __init__(self, path):
         self._path = path
+        # Precomputed so failed attempts don't pay for formatting.
+        self._error_message = "Couldn't lock " + path
         self._lock = threading.Lock()
+        self._owner = None
+
+    def preopen(self):
+        pass
 
     def acquire(self, timeout=None, retry_period=None):
+        # A same-thread re-acquire with a zero timeout can never succeed,
+        # so fail immediately without touching the lock. Longer waits can
+        # legitimately succeed - another thread may call release() - so
+        # they still wait.
+        if timeout == 0 and self._owner == threading.current_thread().ident:
+            raise LockError(self._error_message)
+
         if timeout is None:
             self._lock.acquire()
         else:
@@ -142,46 +418,72 @@ class _ThreadLock(object):
                 acquire=lambda: self._lock.acquire(False),
                 timeout=timeout,
                 retry_period=retry_period,
-                path=self._path,
+                error_message=self._error_message,
             )
 
+        self._owner = threading.current_thread().ident
+
     def release(self):
+        self._owner = None
         self._lock.release()
 
 
 class _LockFile(object):
     def __init__(self, path):
         self._path = path
-        self._file = None
-
-    def acquire(self, timeout=None, retry_period=None):
-        fileobj = open(self._path, "wb")
-
+        # Precomputed so failed attempts don't pay for formatting.
+        self._error_message = "Couldn't lock " + path
+        self._fd = None
+        self._locked = False
+        self._open_lock = threading.Lock()
+
+    def __del__(self):
+        if self._fd is not None:
+            os.close(self._fd)
+
+    def preopen(self):
+        # The fd is kept open across release/acquire cycles: instances
+        # are shared per-path, so re-acquiring only costs the lock syscall
+        # rather than a fresh open and close each time. The check-then-open
+        # needs its own lock: lock_file(preopen=True) calls this on the
+        # shared interned instance without holding _ThreadLock, so it can
+        # race with another thread's preopen or lazy open in acquire,
+        # leaking an fd or overwriting the one that holds the lock.
+        self._open_lock.acquire()
         try:
-            if timeout is None and _lock_file_blocking_available:
-                _lock_file_blocking(fileobj)
-            else:
-                _acquire_non_blocking(
-                    acquire=lambda: _lock_file_non_blocking(fileobj),
-                    timeout=timeout,
-                    retry_period=retry_period,
-                    path=self._path,
-                )
-
-        except:
-            fileobj.close()
-            raise
+            if self._fd is None:
+                self._fd = os.open(self._path, _open_flags, 0o666)
+        finally:
+            self._open_lock.release()
 
+    def acquire(self, timeout=None, retry_period=None):
+        self.preopen()
+        fd = self._fd
+
+        if timeout is None and _lock_file_blocking_available:
+            _lock_file_blocking(fd)
+        elif (timeout is not None and timeout > 0 and
+                _lock_file_blocking_available and
+                _lock_file_blocking_with_timeout(fd, timeout, self._error_message)):
+            # Slept in the kernel until the lock was acquired rather
+            # than polling.
+            pass
         else:
-            self._file = fileobj
+            _acquire_non_blocking(
+                acquire=lambda: _lock_file_non_blocking(fd),
+                timeout=timeout,
+                retry_period=retry_period,
+                error_message=self._error_message,
+            )
+
+        self._locked = True
 
     def release(self):
-        if self._file is None:
+        if not self._locked:
             raise LockError("cannot release unlocked lock")
 
-        _unlock_file(self._file)
-        self._file.close()
-        self._file = None
+        _unlock_file(self._fd)
+        self._locked = False
 
 
 class _Locker(object):
@@ -2,6 +2,7 @@
 
 from __future__ import print_function
 
+import json
 import signal
 import sys
 import os
@@ -9,31 +10,36 @@ import os
 import locket
 
 
-def _print(output):
-    print(output)
+def _print_event(event, **fields):
+    fields["event"] = event
+    print(json.dumps(fields))
     sys.stdout.flush()
 
 
 if __name__ == "__main__":
     signal.signal(signal.SIGTERM, signal.SIG_DFL)
-    print(os.getpid())
-    lock_path = sys.argv[1]
-    if sys.argv[2] == "None":
-        timeout = None
-    else:
-        timeout = float(sys.argv[2])
-    lock = locket.lock_file(lock_path, timeout=timeout)
-
-    _print("Send newline to stdin to acquire")
-    sys.stdin.readline()
-    try:
-        lock.acquire()
-    except locket.LockError:
-        _print("LockError")
-        exit(1)
-    _print("Acquired")
-
-    _print("Send newline to stdin to release")
-    sys.stdin.readline()
-    lock.release()
-    _print("Released")
+    _print_event("started", pid=os.getpid())
+    lock = None
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        command = json.loads(line)
+        op = command["op"]
+        if op == "init":
+            lock = locket.lock_file(command["path"], timeout=command["timeout"])
+            _print_event("ready")
+        elif op == "acquire":
+            try:
+                lock.acquire()
+            except locket.LockError:
+                _print_event("error", error="LockError")
+            else:
+                _print_event("acquired")
+        elif op == "release":
+            lock.release()
+            _print_event("released")
+        elif op == "ping":
+            _print_event("pong")
+        elif op == "exit":
+            break
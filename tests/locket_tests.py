@@ -1,20 +1,18 @@
 import functools
+import json
 import os
-import io
+import subprocess
 import sys
+import threading
 import time
 import signal
 
 import pytest
-import spur
 
 import locket
 from .tempdir import create_temporary_dir
 
 
-local_shell = spur.LocalShell()
-
-
 @pytest.fixture(name="lock_path")
 def _fixture_lock_path():
     with create_temporary_dir() as temp_dir:
@@ -26,7 +24,7 @@ def _fixture_spawn_locker():
     lockers = []
 
     def spawn_locker(*args, **kwargs):
-        locker = _Locker(*args, **kwargs)
+        locker = _Locker(_checkout_worker(), *args, **kwargs)
         lockers.append(locker)
         return locker
 
@@ -34,8 +32,7 @@ def _fixture_spawn_locker():
         yield spawn_locker
     finally:
         for locker in lockers:
-            locker.terminate()
-            locker.wait()
+            locker.close()
 
 
 def test_single_process_can_obtain_uncontested_lock(lock_path):
@@ -136,12 +133,86 @@ def test_the_same_lock_file_object_is_used_for_the_same_path_with_different_argu
     assert first_lock._lock is second_lock._lock
 
 
+def test_the_same_lock_file_object_is_used_for_different_spellings_of_the_same_path(lock_path):
+    link_path = lock_path + "-link"
+    _create_symlink(lock_path, link_path)
+    first_lock = locket.lock_file(lock_path, timeout=0)
+    second_lock = locket.lock_file(link_path, timeout=0)
+    assert first_lock._lock is second_lock._lock
+
+
 def test_different_file_objects_are_used_for_different_paths(lock_path):
     first_lock = locket.lock_file(lock_path, timeout=0)
     second_lock = locket.lock_file(lock_path + "-2", timeout=0)
     assert first_lock._lock is not second_lock._lock
 
 
+def test_single_process_can_obtain_uncontested_locks_on_multiple_paths(lock_path):
+    has_run = False
+    with locket.lock_files([lock_path, lock_path + "-2"]):
+        has_run = True
+
+    assert has_run
+
+
+def test_lock_files_acquires_lock_on_each_path(lock_path):
+    second_path = lock_path + "-2"
+    with locket.lock_files([lock_path, second_path]):
+        for path in [lock_path, second_path]:
+            lock = locket.lock_file(path, timeout=0)
+            try:
+                lock.acquire()
+                assert False, "Expected LockError"
+            except locket.LockError:
+                pass
+
+
+def test_lock_files_deduplicates_different_spellings_of_the_same_path(lock_path):
+    link_path = lock_path + "-link"
+    _create_symlink(lock_path, link_path)
+
+    has_run = False
+    with locket.lock_files([link_path, lock_path], timeout=0):
+        has_run = True
+
+    assert has_run
+
+
+def test_lock_files_releases_acquired_locks_when_one_lock_cannot_be_acquired(lock_path):
+    second_path = lock_path + "-2"
+    with locket.lock_file(second_path, timeout=0):
+        lock = locket.lock_files([lock_path, second_path], timeout=0)
+        try:
+            lock.acquire()
+            assert False, "Expected LockError"
+        except locket.LockError:
+            pass
+
+    with locket.lock_file(lock_path, timeout=0):
+        pass
+
+
+def test_preopen_opens_lock_file_before_acquire(lock_path):
+    has_run = False
+    lock = locket.lock_file(lock_path, preopen=True, timeout=0)
+
+    assert os.path.exists(lock_path)
+
+    with lock:
+        has_run = True
+
+    assert has_run
+
+
+def test_preopen_raises_error_if_lock_file_cannot_be_opened(lock_path):
+    missing_dir_path = os.path.join(lock_path + "-dir", "some-lock")
+    try:
+        locket.lock_file(missing_dir_path, preopen=True)
+        assert False, "Expected error"
+    except (IOError, OSError):
+        pass
+
+
 def test_lock_file_blocks_until_lock_is_available(lock_path, spawn_locker):
     locker_1 = spawn_locker(lock_path)
     locker_2 = spawn_locker(lock_path)
@@ -267,49 +338,140 @@ def test_lock_is_acquired_if_available_before_timeout_expires(lock_path, spawn_l
 
 
 
-class _Locker(object):
-    def __init__(self, path, timeout=None):
-        self._stdout = io.BytesIO()
-        self._stderr = io.BytesIO()
-        self._process = local_shell.spawn(
-            [sys.executable, _locker_script_path, path, str(timeout)],
-            stdout=self._stdout,
-            stderr=self._stderr,
-            allow_error=True,
+def _create_symlink(source, link_path):
+    try:
+        os.symlink(source, link_path)
+    except (AttributeError, NotImplementedError, OSError):
+        pytest.skip("cannot create symlinks on this platform")
+
+
+# Worker processes that finish a test in a clean state are reused by
+# later tests, amortising interpreter startup over the test run.
+_idle_workers = []
+
+
+def _checkout_worker():
+    while _idle_workers:
+        worker = _idle_workers.pop()
+        if worker.is_running():
+            return worker
+    return _Worker()
+
+
+class _Worker(object):
+    def __init__(self):
+        self._process = subprocess.Popen(
+            [sys.executable, _locker_script_path],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
         )
+        self.pid = self._process.pid
+        # Events are parsed incrementally as the worker writes them, so
+        # polling helpers such as has_lock() don't re-decode the entire
+        # accumulated output on every call.
+        self._events = []
+        reader = threading.Thread(target=self._read_stdout)
+        reader.daemon = True
+        reader.start()
+        self._wait_for_started()
+
+    def _read_stdout(self):
+        for line in iter(self._process.stdout.readline, b""):
+            if line.strip():
+                self._events.append(json.loads(line.decode("ascii")))
+
+    def _wait_for_started(self):
+        start_time = time.time()
+        while not self._events:
+            if not self.is_running():
+                raise RuntimeError("Worker did not start, stderr:\n{0}".format(
+                    self._process.stderr.read()))
+            if time.time() - start_time > 5:
+                raise RuntimeError("Worker did not start")
+            time.sleep(0.01)
+
+    def send(self, command):
+        self._process.stdin.write(json.dumps(command).encode("ascii") + b"\n")
+        self._process.stdin.flush()
+
+    def events(self):
+        return list(self._events)
+
+    def is_running(self):
+        return self._process.poll() is None
+
+    def kill(self):
+        if self.is_running():
+            os.kill(self.pid, getattr(signal, "SIGKILL", signal.SIGTERM))
+
+    def wait(self):
+        self._process.wait()
+
+
+class _Locker(object):
+    def __init__(self, worker, path, timeout=None):
+        self._worker = worker
+        self._terminated = False
+        self._start_index = len(worker.events())
+        worker.send({"op": "init", "path": path, "timeout": timeout})
+        if not self._wait_for_event("ready", timeout=5):
+            raise RuntimeError("Worker could not create lock")
 
     def acquire(self):
-        self._process.stdin_write(b"\n")
+        self._worker.send({"op": "acquire"})
 
     def release(self):
-        self._process.stdin_write(b"\n")
+        self._worker.send({"op": "release"})
 
     def wait_for_lock(self):
-        start_time = time.time()
-        while not self.has_lock():
-            if not self._process.is_running():
-                raise self._process.wait_for_result().to_error()
-            time.sleep(0.1)
-            if time.time() - start_time > 1:
-                raise RuntimeError("Could not acquire lock, stdout:\n{0}".format(self._stdout.getvalue()))
+        if not self._wait_for_event("acquired", timeout=1):
+            raise RuntimeError("Could not acquire lock, events: {0}".format(
+                self._worker.events()))
 
     def has_lock(self):
-        lines = self._stdout_lines()
-        return "Acquired" in lines and "Released" not in lines
+        events = self._events()
+        return "acquired" in events and "released" not in events
 
     def has_error(self):
-        return "LockError" in self._stdout_lines()
+        return "error" in self._events()
 
     def terminate(self):
-        pid = int(self._stdout_lines()[0].strip())
-        if self._process.is_running():
-            os.kill(pid, getattr(signal, "SIGKILL", signal.SIGTERM))
+        self._terminated = True
+        self._worker.kill()
 
     def wait(self):
-        self._process.wait_for_result()
+        self._worker.wait()
+
+    def close(self):
+        worker = self._worker
+        if self._terminated or not worker.is_running():
+            worker.wait()
+            return
+        # The worker can be reused if it has answered every command and
+        # isn't still holding (or blocked waiting for) a lock.
+        worker.send({"op": "ping"})
+        if self._wait_for_event("pong", timeout=1) and not self.has_lock():
+            _idle_workers.append(worker)
+        else:
+            worker.kill()
+            worker.wait()
+
+    def _events(self):
+        return [
+            event["event"]
+            for event in self._worker.events()[self._start_index:]
+        ]
+
+    def _wait_for_event(self, name, timeout):
+        start_time = time.time()
+        while name not in self._events():
+            if not self._worker.is_running():
+                return False
+            if time.time() - start_time > timeout:
+                return False
+            time.sleep(0.01)
+        return True
 
-    def _stdout_lines(self):
-        output = self._stdout.getvalue().decode("ascii")
-        return [line.strip() for line in output.split("\n")]
 
 _locker_script_path = os.path.join(os.path.dirname(__file__), "locker.py")